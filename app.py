@@ -6,22 +6,480 @@ Recibe PDF, entrega ZIP. Sin complicaciones.
 
 import os
 import io
+import re
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import tarfile
+import threading
+import time
 import zipfile
-from flask import Flask, request, jsonify, send_file
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import wraps
+from urllib.parse import quote
+from flask import Flask, Response, abort, request, jsonify, send_file
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import fitz  # PyMuPDF
-from PIL import Image
+import simplejpeg
+from render import IMAGE_QUALITY, JPEG_SUBSAMPLING, JPEG_OPTIMIZE, encode_page, render_pages
 
 app = Flask(__name__)
+# Railway agrega un proxy: remote_addr = la IP que ese proxy agregó a la derecha de
+# X-Forwarded-For (las entradas de la izquierda las controla el cliente)
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', '1'))
+if PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('pdf2jpg')
 
 # Configuración simple
 API_KEY = os.environ.get('API_KEY', 'your-api-key')
 MAX_SIZE_MB = int(os.environ.get('MAX_SIZE_MB', '20'))
 MAX_SIZE_BYTES = MAX_SIZE_MB * 1024 * 1024
+MAX_PAGES = int(os.environ.get('MAX_PAGES', '100'))
+# Werkzeug rechaza bodies mayores sin leerlos (1MB extra para multipart/JSON)
+app.config['MAX_CONTENT_LENGTH'] = MAX_SIZE_BYTES + 1024 * 1024
+# Procesos de render del worker; por defecto se reparten los núcleos entre los workers de gunicorn
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', '2'))
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+# Conversiones simultáneas por worker: acota documentos abiertos y carga de render
+# (por defecto núcleos / WEB_CONCURRENCY, máx. 3). No reserva hilos de gunicorn: descargas,
+# la espera del turno y los aciertos de cache también ocupan hilos fuera de este límite
+MAX_CONCURRENT_CONVERT = int(os.environ.get('MAX_CONCURRENT_CONVERT', max(1, min(3, (os.cpu_count() or 1) // WEB_CONCURRENCY))))
+# Espera corta por un turno antes de responder 503, para no acumular hilos bloqueados
+CONVERT_QUEUE_TIMEOUT = 2
+convert_slots = threading.BoundedSemaphore(MAX_CONCURRENT_CONVERT)
+RATE_LIMIT_PER_MINUTE = int(os.environ.get('RATE_LIMIT_PER_MINUTE', '10'))  # 0 = sin límite
+MAX_DPI = int(os.environ.get('MAX_DPI', '200'))
+IMAGE_DPI = min(int(os.environ.get('IMAGE_DPI', '144')), MAX_DPI)  # 144 DPI = zoom 2x
+# Matrices de render precalculadas para los DPI habituales
+_MATRIX_CACHE = {dpi: fitz.Matrix(dpi / 72, dpi / 72) for dpi in {72, 96, 144, 150, 200, IMAGE_DPI} if dpi <= MAX_DPI}
+
+# Cache de archivos ya convertidos por hash del PDF (vacío = desactivado)
+CACHE_DIR = os.environ.get('CACHE_DIR', '')
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_MB', '500')) * 1024 * 1024
+# Detrás de nginx: location interna que sirve CACHE_DIR (vacío = servir desde Python)
+CACHE_ACCEL_PREFIX = os.environ.get('CACHE_ACCEL_PREFIX', '')
+# Un .tmp sin escrituras en 10 minutos se da por abandonado. --timeout de gunicorn no acota
+# la duración de una request (gthread), así que puede ser de un cliente lento: esa request
+# detecta que su .tmp ya no es suyo y no lo publica
+CACHE_TMP_TTL = 600
+if CACHE_DIR:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+
+# simplejpeg trae libjpeg-turbo (SIMD) en su wheel; dejarlo en el log de arranque
+logger.info('Render: PyMuPDF %s (MuPDF %s) | JPEG: libjpeg-turbo vía simplejpeg %s',
+            fitz.VersionBind, fitz.VersionFitz, simplejpeg.__version__)
+
+# Sesión HTTP compartida: reutiliza conexiones TCP/TLS (Supabase, URLs) entre requests
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20,
+                       max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False))
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+# Rate limiting: timestamps del último minuto por IP, acotados a RATE_LIMIT_PER_MINUTE
+request_cache = defaultdict(lambda: deque(maxlen=RATE_LIMIT_PER_MINUTE))
+request_cache_lock = threading.Lock()
+
+def rate_limit(view):
+    """Limitar requests por IP (ventana deslizante de 60s)"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if RATE_LIMIT_PER_MINUTE > 0:
+            client_ip = request.remote_addr
+            current_time = time.monotonic()
+            minute_ago = current_time - 60
+            with request_cache_lock:
+                timestamps = request_cache[client_ip]
+                while timestamps and timestamps[0] <= minute_ago:
+                    timestamps.popleft()
+                if len(timestamps) >= RATE_LIMIT_PER_MINUTE:
+                    return jsonify({'error': 'Rate limit exceeded'}), 429
+                timestamps.append(current_time)
+        return view(*args, **kwargs)
+    return wrapper
+
+def _sweep_request_cache():
+    """Olvidar IPs sin requests en el último minuto para acotar memoria"""
+    while True:
+        time.sleep(60)
+        minute_ago = time.monotonic() - 60
+        with request_cache_lock:
+            for client_ip in [ip for ip, timestamps in request_cache.items() if not timestamps or timestamps[-1] <= minute_ago]:
+                del request_cache[client_ip]
+
+if RATE_LIMIT_PER_MINUTE > 0:
+    threading.Thread(target=_sweep_request_cache, daemon=True).start()
+
+def _json_body():
+    """Body JSON como dict ({} si falta, es inválido o no es un objeto, p. ej. [1, 2])"""
+    data = request.get_json(silent=True) if request.is_json else None
+    return data if isinstance(data, dict) else {}
 
 def require_auth():
-    """Verificar API key"""
-    provided_key = request.headers.get('X-API-Key') or request.json.get('api_key') if request.is_json else None
-    return provided_key == API_KEY
+    """Verificar API key (header primero; el body solo se parsea si falta)"""
+    provided_key = request.headers.get('X-API-Key') or _json_body().get('api_key')
+    if not isinstance(provided_key, str):
+        return False
+    # Comparación en tiempo constante: no filtrar el prefijo correcto por timing
+    return hmac.compare_digest(provided_key.encode(), API_KEY.encode())
+
+def _int_param(name, default=None):
+    """Parámetro entero positivo desde query/form/JSON"""
+    value = request.values.get(name) or _json_body().get(name)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(400, f'{name} must be an integer')
+    if value <= 0:
+        abort(400, f'{name} must be positive')
+    return value
+
+_CONTROL_CHARS = re.compile(r'[\x00-\x1f\x7f\\]')
+
+def _check_url(url):
+    """Solo http(s); otros esquemas fallarían recién al descargar"""
+    if not isinstance(url, str) or not url.startswith(('https://', 'http://')):
+        abort(400, 'Invalid URL')
+    return url
+
+def _storage_object_url(data):
+    """URL del objeto en Supabase Storage, rechazando rutas inválidas antes de ir a la red"""
+    supabase_url = _check_url(data.get('supabase_url')).rstrip('/')
+    bucket, file_id = data.get('bucket'), data.get('file_id')
+    if not isinstance(bucket, str) or not isinstance(file_id, str) or len(file_id) > 1024:
+        abort(400, 'Invalid bucket or file_id')
+    # Sin segmentos vacíos, '.' o '..' (path traversal), ni '\' ni caracteres de control
+    if (bucket in ('', '.', '..') or '/' in bucket
+            or any(segment in ('', '.', '..') for segment in file_id.split('/'))
+            or _CONTROL_CHARS.search(bucket + file_id)):
+        abort(400, 'Invalid bucket or file_id')
+    return f"{supabase_url}/storage/v1/object/{quote(bucket, safe='')}/{quote(file_id)}"
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def _download_pdf(url, headers=None):
+    """Descargar PDF, cortando al superar MAX_SIZE_BYTES"""
+    response = SESSION.get(url, headers=headers, stream=True, timeout=30)
+    response.raise_for_status()
+    content_length = int(response.headers.get('Content-Length') or 0)
+    if content_length > MAX_SIZE_BYTES:
+        response.close()
+        abort(400, f'File too large. Max {MAX_SIZE_MB}MB')
+    
+    if content_length and response.headers.get('Content-Encoding', 'identity') == 'identity':
+        # Tamaño conocido: un solo buffer preasignado, leído en su lugar
+        pdf_data = bytearray(content_length)
+        with memoryview(pdf_data) as view:
+            received = 0
+            while received < content_length:
+                n = response.raw.readinto(view[received:])
+                if not n:
+                    break
+                received += n
+        del pdf_data[received:]
+        return pdf_data
+    
+    # Sin tamaño conocido o comprimido (gzip/deflate): leer por bloques y cortar apenas lo
+    # descomprimido supera el límite. Cada paso de decodificación queda acotado también con
+    # urllib3 < 2.6, que descomprime de una vez todo lo que se le pide a raw.read
+    pdf_data = bytearray()
+    for chunk in response.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=True):
+        pdf_data += chunk
+        if len(pdf_data) > MAX_SIZE_BYTES:
+            response.close()
+            abort(400, f'File too large. Max {MAX_SIZE_MB}MB')
+    return pdf_data
+
+def _check_magic(pdf_data):
+    """Validación barata: cabecera %PDF- en el primer KB (sin parsear el documento)"""
+    if b'%PDF-' not in pdf_data[:1024]:
+        abort(400, 'Invalid PDF')
+
+def _open_pdf(pdf_data):
+    """Abrir el PDF una sola vez y validar el número de páginas"""
+    try:
+        doc = fitz.open(stream=pdf_data, filetype="pdf")
+    except fitz.FileDataError:
+        abort(400, 'Invalid PDF')
+    if doc.needs_pass:
+        # Con contraseña de usuario no se puede renderizar: fallar antes de empezar el stream
+        doc.close()
+        abort(400, 'Encrypted PDF')
+    if doc.page_count == 0 or doc.page_count > MAX_PAGES:
+        page_count = doc.page_count
+        doc.close()
+        abort(400, f'PDF must have between 1 and {MAX_PAGES} pages (got {page_count})')
+    return doc
+
+# Páginas por tarea del pool: más páginas = menos parseos, pero más JPG esperando al cliente
+MAX_SHARD_PAGES = 4
+
+# Un pool de render por worker de gunicorn, compartido por todas sus conversiones
+render_pool = None
+render_pool_lock = threading.Lock()
+
+def _render_pool():
+    """Pool del worker; se crea una vez y solo se rehace si un proceso murió"""
+    global render_pool
+    with render_pool_lock:
+        if render_pool is None:
+            # forkserver: los hijos no heredan los hilos del worker ni el estado de MuPDF
+            # de otras requests; arrancan con render (PyMuPDF, numpy, simplejpeg) ya importado
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['render'])
+            render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=context)
+            for _ in range(RENDER_WORKERS):
+                render_pool.submit(os.getpid)  # Levantar los procesos antes del primer PDF
+        return render_pool
+
+def _discard_render_pool(executor):
+    """Descartar un pool roto (OOM, crash de MuPDF); el próximo uso crea otro"""
+    global render_pool
+    with render_pool_lock:
+        if render_pool is executor:
+            render_pool = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def _iter_pages(doc, pdf_data, matrix, max_size=None):
+    """Generar los JPG en orden de página"""
+    page_count = len(doc)
+    if page_count <= 2 or RENDER_WORKERS <= 1:
+        for page_num in range(page_count):
+            yield encode_page(doc[page_num], matrix, max_size)
+    else:
+        # Rangos de páginas → procesos del pool. Cada rango envía el PDF y lo
+        # parsea una sola vez; ~4 rangos por proceso mantienen el streaming fluido.
+        # Rangos de hasta MAX_SHARD_PAGES y 2 rangos por proceso en vuelo: como mucho
+        # 2 · workers · MAX_SHARD_PAGES JPG en memoria, sin importar el largo del documento
+        workers = min(RENDER_WORKERS, page_count)
+        shard_size = min(-(-page_count // (workers * 4)), MAX_SHARD_PAGES)
+        executor = _render_pool()
+        pending = deque()
+        try:
+            for first in range(0, page_count, shard_size):
+                last = min(first + shard_size, page_count)
+                pending.append(executor.submit(render_pages, pdf_data, first, last, matrix, max_size))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        except BrokenProcessPool:
+            _discard_render_pool(executor)
+            raise
+        finally:
+            # Si el cliente se desconecta, no renderizar rangos que nadie recibirá
+            for future in pending:
+                future.cancel()
+
+class _ResponseStream:
+    """Destino de solo escritura para zipfile/tarfile; acumula bytes hasta el siguiente drain()"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def write(self, data):
+        self._chunks.append(data)
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _zip_stream(doc, pdf_data, matrix, max_size=None):
+    """Escribir el ZIP página a página y entregarlo en partes"""
+    stream = _ResponseStream()
+    date_time = time.localtime()[:6]  # Una sola fecha para todas las entradas
+    try:
+        # JPG ya está comprimido: deflate no ahorra nada y cuesta CPU
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as zip_file:
+            for page_num, jpg_data in enumerate(_iter_pages(doc, pdf_data, matrix, max_size), 1):
+                info = zipfile.ZipInfo(f'page_{page_num:03d}.jpg', date_time)
+                info.compress_type = zipfile.ZIP_STORED
+                info.external_attr = 0o600 << 16
+                zip_file.writestr(info, jpg_data)
+                yield stream.drain()
+        yield stream.drain()  # Directorio central
+    finally:
+        doc.close()
+
+def _tar_stream(doc, pdf_data, matrix, max_size=None):
+    """Igual que _zip_stream pero en tar: sin CRC por entrada ni directorio central"""
+    stream = _ResponseStream()
+    mtime = int(time.time())  # Entero: un float obliga a un header PAX (~1KB) por entrada
+    try:
+        with tarfile.open(fileobj=stream, mode='w|') as tar_file:
+            for page_num, jpg_data in enumerate(_iter_pages(doc, pdf_data, matrix, max_size), 1):
+                info = tarfile.TarInfo(f'page_{page_num:03d}.jpg')
+                info.size = len(jpg_data)
+                info.mtime = mtime
+                info.mode = 0o600
+                tar_file.addfile(info, io.BytesIO(jpg_data))
+                yield stream.drain()
+        yield stream.drain()  # Bloques finales
+    finally:
+        doc.close()
+
+# Formatos de salida según el header Accept (ZIP por defecto)
+ARCHIVE_FORMATS = {
+    'application/zip': (_zip_stream, 'converted.zip'),
+    'application/x-tar': (_tar_stream, 'converted.tar'),
+}
+
+def _cache_path(pdf_data, dpi, max_size, filename):
+    """Ruta en cache para este PDF con estos parámetros de render"""
+    key = hashlib.sha256(pdf_data)
+    key.update(f'{dpi}:{max_size}:{IMAGE_QUALITY}:{JPEG_SUBSAMPLING}:{JPEG_OPTIMIZE}'.encode())
+    return os.path.join(CACHE_DIR, key.hexdigest() + os.path.splitext(filename)[1])
+
+# Avisa al hilo de mantenimiento que el cache creció
+cache_grew = threading.Event()
+
+def _evict_cache():
+    """LRU por tamaño total: borrar los menos usados (mtime) hasta entrar en CACHE_MAX_BYTES"""
+    entries = []
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # Otro worker lo evictó mientras tanto
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def _is_own_file(path, identity):
+    """¿path sigue siendo el archivo que abrimos? (otra request pudo crear uno con el mismo nombre)"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return (stat.st_dev, stat.st_ino) == identity
+
+def _close_quietly(cache_file):
+    """Cerrar el .tmp ignorando errores de disco (el flush final puede fallar)"""
+    try:
+        cache_file.close()
+    except OSError:
+        pass
+
+def _publish_cache_file(cache_file, tmp_path, cache_path, identity):
+    """Cerrar y renombrar el .tmp completo; False si no se pudo, sin cortar la respuesta"""
+    try:
+        cache_file.close()
+        # Si el barrido borró nuestro .tmp y otra request creó uno nuevo, no publicar el ajeno
+        if not _is_own_file(tmp_path, identity):
+            return False
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning('Cache publish failed, not caching this archive: %s', e)
+        return False
+    cache_grew.set()  # La evicción corre en el hilo de mantenimiento
+    return True
+
+def _cached_stream(stream, cache_path):
+    """Copiar al cache lo que se envía; solo se publica si el archivo se completó"""
+    tmp_path = cache_path + '.tmp'
+    try:
+        cache_file = open(tmp_path, 'xb')  # O_EXCL: también marca la conversión en curso
+    except OSError:
+        # Otra request ya lo está generando (o el disco no admite escritura)
+        yield from stream
+        return
+    stat = os.fstat(cache_file.fileno())
+    identity = (stat.st_dev, stat.st_ino)
+    published = False
+    try:
+        for chunk in stream:
+            if cache_file:
+                try:
+                    cache_file.write(chunk)
+                except OSError as e:
+                    # El cache es opcional: un disco lleno no corta la respuesta, solo deja de copiar
+                    logger.warning('Cache write failed, not caching this archive: %s', e)
+                    cache_file = _close_quietly(cache_file)
+            yield chunk
+        if cache_file:
+            published = _publish_cache_file(cache_file, tmp_path, cache_path, identity)
+            cache_file = None
+    finally:
+        stream.close()  # Si el cliente cortó, cancelar el render pendiente
+        if cache_file:
+            _close_quietly(cache_file)
+        # Borrar solo nuestro .tmp: tras publicar, el nombre puede ser de otra request
+        if not published:
+            try:
+                if _is_own_file(tmp_path, identity):
+                    os.remove(tmp_path)
+            except OSError:
+                pass  # Lo borrará el barrido de .tmp abandonados
+
+def _sweep_cache_tmp():
+    """Borrar .tmp que dejó un worker reciclado o caído a mitad de una conversión"""
+    stale = time.time() - CACHE_TMP_TTL
+    with os.scandir(CACHE_DIR) as it:
+        for entry in it:
+            if not entry.name.endswith('.tmp'):
+                continue
+            try:
+                if entry.stat().st_mtime < stale:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # Publicado o borrado mientras tanto
+
+def _maintain_cache():
+    """Evicción LRU tras cada archivo nuevo y limpieza periódica de .tmp abandonados"""
+    while True:
+        grew = cache_grew.wait(timeout=120)
+        cache_grew.clear()
+        try:
+            if grew:
+                _evict_cache()
+            _sweep_cache_tmp()
+        except Exception:
+            # Un error puntual (disco, permisos) no debe dejar el worker sin mantenimiento
+            logger.exception('Cache maintenance failed')
+
+if CACHE_DIR:
+    threading.Thread(target=_maintain_cache, daemon=True).start()
+
+# Pre-calentar el pool al importar en cada worker (no en el proceso forkserver,
+# que importa este módulo como __mp_main__ cuando se corre con python app.py)
+if RENDER_WORKERS > 1 and __name__ != '__mp_main__':
+    _render_pool()
+
+@app.errorhandler(HTTPException)
+def http_error(e):
+    """Errores HTTP (abort) como JSON"""
+    return jsonify({'error': e.description}), e.code
+
+@app.errorhandler(413)
+def payload_too_large(e):
+    """Body mayor a MAX_CONTENT_LENGTH"""
+    return jsonify({'error': f'File too large. Max {MAX_SIZE_MB}MB'}), 413
 
 @app.route('/health')
 def health():
@@ -29,10 +487,19 @@ def health():
     return jsonify({
         'status': 'ok',
         'max_size_mb': MAX_SIZE_MB,
-        'api_key_required': bool(API_KEY)
+        'max_pages': MAX_PAGES,
+        'quality': IMAGE_QUALITY,
+        'jpeg_optimize': JPEG_OPTIMIZE,
+        'cache_enabled': bool(CACHE_DIR),
+        'dpi': IMAGE_DPI,
+        'max_dpi': MAX_DPI,
+        'api_key_required': bool(API_KEY),
+        'rate_limit_per_minute': RATE_LIMIT_PER_MINUTE,
+        'max_concurrent_convert': MAX_CONCURRENT_CONVERT
     })
 
 @app.route('/convert', methods=['POST'])
+@rate_limit
 def convert():
     """Convertir PDF a JPG → ZIP"""
     
@@ -41,6 +508,12 @@ def convert():
         return jsonify({'error': 'API key required'}), 401
     
     try:
+        # Parámetros primero: un dpi inválido no debe costar una descarga de hasta MAX_SIZE_MB
+        # Píxeles por página = ancho·alto·dpi²/72²: el costo crece con el cuadrado
+        dpi = min(_int_param('dpi', IMAGE_DPI), MAX_DPI)
+        matrix = _MATRIX_CACHE.get(dpi) or fitz.Matrix(dpi / 72, dpi / 72)
+        max_size = _int_param('max_size')  # Lado mayor en píxeles (opcional)
+        
         # Obtener PDF
         pdf_data = None
         
@@ -48,21 +521,17 @@ def convert():
             # Upload directo
             file = request.files['file']
             pdf_data = file.read()
-        elif request.is_json and 'url' in request.json:
+        elif 'url' in _json_body():
             # Desde URL
-            import requests
-            response = requests.get(request.json['url'], timeout=30)
-            response.raise_for_status()
-            pdf_data = response.content
-        elif request.is_json and 'file_id' in request.json:
+            pdf_data = _download_pdf(_check_url(_json_body()['url']))
+        elif 'file_id' in _json_body():
             # Desde Supabase
-            data = request.json
-            import requests
-            url = f"{data['supabase_url']}/storage/v1/object/{data['bucket']}/{data['file_id']}"
+            data = _json_body()
+            url = _storage_object_url(data)
+            if not data.get('service_key'):
+                abort(400, 'service_key required')
             headers = {'Authorization': f"Bearer {data['service_key']}"}
-            response = requests.get(url, headers=headers, timeout=30)
-            response.raise_for_status()
-            pdf_data = response.content
+            pdf_data = _download_pdf(url, headers=headers)
         else:
             return jsonify({'error': 'No PDF provided'}), 400
         
@@ -70,45 +539,57 @@ def convert():
         if len(pdf_data) > MAX_SIZE_BYTES:
             return jsonify({'error': f'File too large. Max {MAX_SIZE_MB}MB'}), 400
         
-        # Convertir PDF → JPG
-        doc = fitz.open(stream=pdf_data, filetype="pdf")
-        images = []
-        
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))  # 2x zoom
-            img_data = pix.tobytes("ppm")
-            
-            # PIL para JPG
-            pil_img = Image.open(io.BytesIO(img_data))
-            if pil_img.mode != 'RGB':
-                pil_img = pil_img.convert('RGB')
-            
-            jpg_buffer = io.BytesIO()
-            pil_img.save(jpg_buffer, format='JPEG', quality=90)
-            images.append((f'page_{page_num+1:03d}.jpg', jpg_buffer.getvalue()))
-        
-        doc.close()
+        _check_magic(pdf_data)
         
-        # Crear ZIP
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for filename, img_data in images:
-                zip_file.writestr(filename, img_data)
+        mimetype = request.accept_mimetypes.best_match(ARCHIVE_FORMATS, default='application/zip')
+        archive_stream, filename = ARCHIVE_FORMATS[mimetype]
         
-        zip_buffer.seek(0)
+        # Mismo PDF y parámetros: servir el archivo ya convertido sin abrir el documento
+        cache_path = _cache_path(pdf_data, dpi, max_size, filename) if CACHE_DIR else None
+        if cache_path:
+            try:
+                os.utime(cache_path)  # Marcar como usado recientemente (LRU)
+                if CACHE_ACCEL_PREFIX:
+                    # nginx envía el archivo con sendfile(2) y el worker queda libre de inmediato
+                    return Response(mimetype=mimetype, headers={
+                        'X-Accel-Redirect': CACHE_ACCEL_PREFIX.rstrip('/') + '/' + os.path.basename(cache_path),
+                        'Content-Disposition': f'attachment; filename={filename}',
+                        'Vary': 'Accept'
+                    })
+                response = send_file(cache_path, mimetype=mimetype, as_attachment=True, download_name=filename)
+                response.vary.add('Accept')
+                return response
+            except FileNotFoundError:
+                pass  # No está en cache, o la evicción lo borró recién: convertir
         
-        # Retornar ZIP
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='converted.zip'
-        )
+        # Back-pressure: acotar documentos abiertos y procesos de render por worker
+        if not convert_slots.acquire(timeout=CONVERT_QUEUE_TIMEOUT):
+            abort(503, 'Server busy, try again later')
+        try:
+            # Convertir PDF → JPG → ZIP, enviando cada página apenas se codifica
+            doc = _open_pdf(pdf_data)
+            stream = archive_stream(doc, pdf_data, matrix, max_size)
+            if cache_path:
+                stream = _cached_stream(stream, cache_path)
+            response = Response(
+                stream,
+                mimetype=mimetype,
+                # ZIP o tar según Accept: los caches intermedios deben distinguirlos
+                headers={'Content-Disposition': f'attachment; filename={filename}', 'Vary': 'Accept'}
+            )
+        except BaseException:
+            convert_slots.release()
+            raise
+        # El turno se libera al cerrar la respuesta (completa o cortada por el cliente)
+        response.call_on_close(convert_slots.release)
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
+    # Solo desarrollo; en producción corre con gunicorn (ver Dockerfile)
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
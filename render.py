@@ -0,0 +1,36 @@
+"""
+Render de páginas PDF → JPG.
+Módulo aparte para que los procesos del pool solo importen PyMuPDF, numpy y simplejpeg (no Flask).
+"""
+
+import os
+import fitz  # PyMuPDF
+import numpy as np
+import simplejpeg  # libjpeg-turbo
+import mozjpeg_lossless_optimization  # Huffman óptimo + progresivo (mozjpeg)
+
+# 4:2:0 es indistinguible en páginas rasterizadas y reduce a la mitad los datos de color
+IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', '85'))
+JPEG_SUBSAMPLING = '420'
+# Re-optimización sin pérdida con mozjpeg: ~15% menos bytes en páginas densas, ~10x más CPU por página
+JPEG_OPTIMIZE = os.environ.get('JPEG_OPTIMIZE', '0') == '1'
+
+def encode_page(page, matrix, max_size=None):
+    """Renderizar una página y codificarla como JPG"""
+    if max_size:
+        # Limitar el lado mayor sin sobre-renderizar páginas grandes (A3, planos)
+        longest = max(page.rect.width, page.rect.height) * matrix.a
+        if longest > max_size:
+            scale = max_size / longest
+            matrix = fitz.Matrix(matrix.a * scale, matrix.d * scale)
+    pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csRGB, alpha=False)  # RGB, 3 canales
+    # Buffer RGB de MuPDF directo a libjpeg-turbo (sin PPM ni PIL)
+    pixels = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    # El pixmap se libera al salir, antes de renderizar la siguiente página
+    jpeg = simplejpeg.encode_jpeg(pixels, quality=IMAGE_QUALITY, colorspace='RGB', colorsubsampling=JPEG_SUBSAMPLING)
+    return mozjpeg_lossless_optimization.optimize(jpeg) if JPEG_OPTIMIZE else jpeg
+
+def render_pages(pdf_data, first, last, matrix, max_size=None):
+    """Renderizar un rango de páginas en un proceso del pool (un solo parseo por rango)"""
+    with fitz.open(stream=pdf_data, filetype="pdf") as doc:
+        return [encode_page(doc[page_num], matrix, max_size) for page_num in range(first, last)]